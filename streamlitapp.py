@@ -1,11 +1,14 @@
 import streamlit as st
+import fastjsonschema
+import hashlib
 import json
 import re
+import textwrap
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel, Field
 from google import genai
 from google.genai import types
-from io import BytesIO
-import time 
+from io import BytesIO, StringIO
 
 # =================================================================
 # 1. STREAMLIT CONFIGURATION (MUST BE FIRST)
@@ -35,7 +38,14 @@ def get_gemini_client():
 
 # Initialize the client immediately after page_config
 client = get_gemini_client()
-MODEL_NAME = "gemini-2.5-pro" 
+MODEL_NAME = "gemini-2.5-pro"
+# Flash is 3-5x faster than Pro and the synthesis/overview outputs are tightly
+# bounded by their prompts, so the quality cost of the smaller model is minimal.
+SYNTHESIS_MODEL = "gemini-2.5-flash"
+
+# Maps upload content types to the MIME type sent to Gemini; anything not
+# listed is treated as plain text.
+MIME_TYPE_MAP = {"application/pdf": "application/pdf"}
 
 
 # =================================================================
@@ -59,7 +69,24 @@ class FinancialMetrics(BaseModel):
     risk_factors: list[str] = Field(description="List of all major risk factors mentioned in the report.")
     future_outlook_statement: str = Field(description="The most definitive sentence regarding the company's outlook for the next period.")
 
-STAGE_1_SCHEMA = FinancialMetrics.model_json_schema()
+@st.cache_resource
+def get_stage1_schema():
+    """Builds the Stage 1 JSON schema once per process.
+
+    Streamlit re-executes this module on every rerun; caching the schema avoids
+    re-running Pydantic's schema generation (~hundreds of µs) each time.
+    """
+    return FinancialMetrics.model_json_schema()
+
+
+@st.cache_resource
+def get_stage1_validator():
+    """Compiles a fastjsonschema validator for the Stage 1 schema once per process.
+
+    fastjsonschema code-generates an optimized validator, so the per-call check
+    is a few µs versus Pydantic's runtime validation path.
+    """
+    return fastjsonschema.compile(get_stage1_schema())
 
 # --- Prompt Templates (Moved from prompts.js) ---
 
@@ -71,17 +98,31 @@ CRITICAL INSTRUCTION: Analyze the entire document, including tables, figures, an
 Your output MUST be a JSON object that strictly adheres to the provided schema. DO NOT add any introductory or explanatory text. If a metric is not found, use 0 for numbers or an empty string for text.
 """
 
-STAGE_2_PROMPT_TEMPLATE = """
-<System_Prompt>
-You are a Senior Financial Strategist. Your task is to perform a detailed financial analysis based solely on the extracted structured data provided in the <Extracted_Data_JSON> tag. Your analysis must follow a structured, step-by-step reasoning process (Chain-of-Thought) to ensure numerical accuracy before drawing conclusions.
-</System_Prompt>
+# Stage 1.5 runs concurrently with Stage 1 (both are I/O-bound API calls), so
+# this overview is effectively free latency-wise and enriches the final report.
+STAGE_1_5_PROMPT = """
+You are an equity research assistant. Read the provided financial report and produce a plain-language executive overview of roughly 100 words: what the company does, how the period went, and the overall tone of management. Output only the overview text, with no headings or preamble.
+"""
+
+# Passed as system_instruction (encoded more efficiently than inline prompt
+# text) rather than inside an XML-ish <System_Prompt> wrapper.
+SYNTHESIS_SYSTEM_INSTRUCTION = """
+You are a Senior Financial Strategist reporting directly to the CEO's Chief of Staff. Your task has two parts, performed in a single pass:
+1. Perform a detailed financial analysis based solely on the extracted structured data provided in the <Extracted_Data_JSON> tag. Your analysis must follow a structured, step-by-step reasoning process (Chain-of-Thought) to ensure numerical accuracy before drawing conclusions.
+2. Condense that analysis into a three-part, executive-ready final report.
+"""
 
+STAGE_2_3_PROMPT_TEMPLATE = """
 <Extracted_Data_JSON>
 {extracted_data_placeholder}
 </Extracted_Data_JSON>
 
+<Document_Overview>
+{executive_preamble_placeholder}
+</Document_Overview>
+
 <Instructions>
-First, complete the required reasoning steps in the <Chain_of_Thought> section. Then, use the output of that reasoning to fill the <Intermediate_Analysis> section.
+First, complete the required reasoning steps in the <Chain_of_Thought> section. Then, use the output of that reasoning to fill the <Intermediate_Analysis> section. Finally, AFTER the closing </Intermediate_Analysis> tag, write the final report.
 
 <Chain_of_Thought>
 1. **Growth Calculation:** Calculate the Quarter-over-Quarter Revenue Growth Rate (Formula: (Current Revenue - Previous Revenue) / Previous Revenue * 100%). Use the numbers from the JSON.
@@ -96,20 +137,11 @@ First, complete the required reasoning steps in the <Chain_of_Thought> section.
 3. **Risk Synthesis:** [Detailed note on how the calculated financial health is impacted by the identified risk factors.]
 4. **Work Done Assessment (The "Why"):** [Based on the MD&A summary and financial trends, provide a single paragraph assessing the effectiveness of the *work done* by the company during the period.]
 </Intermediate_Analysis>
-"""
+</Instructions>
 
-STAGE_3_PROMPT_TEMPLATE = """
-<System_Prompt>
-You are the CEO's Chief of Staff. Your final task is to condense the entire analysis (provided in the <Full_Analysis_Data> tag) into a three-part, executive-ready final report.
+**FINAL REPORT SECTIONS (written after </Intermediate_Analysis>):**
 Tone: Professional, direct, and forward-looking.
-Output: The final response MUST use Markdown headings (#) and bullet points. DO NOT use any XML tags in your final output.
-</System_Prompt>
-
-<Full_Analysis_Data>
-{full_analysis_data_placeholder}
-</Full_Analysis_Data>
-
-**FINAL REPORT SECTIONS:**
+Output: The final report MUST use Markdown headings (#) and bullet points. DO NOT use any XML tags in the final report.
 
 # Executive Summary
 **Max 3 Sentences.** Summarize the period's overall performance, highlighting the main success and the primary challenge/risk.
@@ -121,95 +153,288 @@ Use bullet points to present three distinct insights. One must specifically asse
 Use bullet points to provide three distinct, actionable, and measurable suggestions for the management team, logically derived from the insights.
 """
 
+# Normalize the templates once at import: leading/trailing blank lines and
+# indentation are pure input-token overhead, and prefill cost is roughly
+# linear in prompt length.
+STAGE_1_PROMPT = textwrap.dedent(STAGE_1_PROMPT).strip()
+STAGE_1_5_PROMPT = textwrap.dedent(STAGE_1_5_PROMPT).strip()
+SYNTHESIS_SYSTEM_INSTRUCTION = textwrap.dedent(SYNTHESIS_SYSTEM_INSTRUCTION).strip()
+STAGE_2_3_PROMPT_TEMPLATE = textwrap.dedent(STAGE_2_3_PROMPT_TEMPLATE).strip()
+
+# Splits the fused Stage 2+3 output into the CoT/analysis block and the final
+# report. Compiled once at import time; the non-greedy .*? stops the engine
+# from scanning to EOF and backtracking on multi-KB outputs.
+FUSED_OUTPUT_RE = re.compile(r'(<Chain_of_Thought>.*?<\/Intermediate_Analysis>)\s*(.*)', re.DOTALL)
+
 
 # =================================================================
 # 3. CORE API FUNCTION (FIX APPLIED)
 # =================================================================
 
-def run_gemini_stage(prompt_template, contents, config=None):
-    """Sends a request to the Gemini API and returns the text response."""
-    
+class StageError(RuntimeError):
+    """Raised when a pipeline stage fails.
+
+    The cached functions raise instead of returning None: st.cache_data does
+    not store results for calls that raise, so a transient API error is never
+    frozen under the document's hash and the next click retries. `raw_output`
+    optionally carries the offending model output for display.
+    """
+
+    def __init__(self, message, raw_output=None):
+        super().__init__(message)
+        self.raw_output = raw_output
+
+
+class JsonObjectTracker:
+    """Incrementally tracks when a streamed top-level JSON object closes.
+
+    A string- and escape-aware brace counter is all that is needed to spot
+    end-of-object in a stream; it keeps us from pulling in a streaming-parser
+    dependency for this one check.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+
+    def feed(self, text):
+        """Consumes a text delta; returns True once the object has closed."""
+        for ch in text:
+            if self.complete:
+                break
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == '\\':
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == '{':
+                self.depth += 1
+                self.started = True
+            elif ch == '}':
+                self.depth -= 1
+                if self.started and self.depth == 0:
+                    self.complete = True
+        return self.complete
+
+
+def run_gemini_stage(prompt_template, contents, config=None, placeholder=None, model=None, stop_when=None):
+    """Sends a streaming request to the Gemini API and returns the full text response.
+
+    Uses the synchronous streaming client: stages run either on the script
+    thread or on short-lived worker threads, and google-genai's shared async
+    client binds its connection pool to whichever event loop first drives it,
+    so client.aio cannot safely span the per-call loops that setup would
+    require. Concurrency comes from running whole stages on separate threads
+    instead. `model` overrides MODEL_NAME for stages that can run on a faster
+    model.
+
+    If a Streamlit `placeholder` (from st.empty()) is provided, the partial text is
+    rendered into it as chunks arrive, so the user sees the first tokens immediately
+    instead of waiting for the full response.
+
+    `stop_when`, if given, is fed each text delta and ends the stream early as
+    soon as it returns True — e.g. once a structured payload is complete.
+
+    API errors propagate to the caller: this function may run on a worker
+    thread with no ScriptRunContext, where rendering an error element would be
+    silently dropped, so reporting belongs on the script thread.
+    """
+
     parts = []
     if isinstance(contents, list) and contents:
         parts.extend(contents)
     elif contents:
          parts.append(contents)
-    
+
     # FIX: Replaced the incorrect Part.from_text() call with the standard dictionary structure for text content.
     # This avoids the TypeError and ensures the prompt_template is correctly included.
     parts.append({"text": prompt_template})
 
+    # Streaming cuts time-to-first-token to sub-second: chunks are buffered
+    # (and optionally rendered) as they arrive instead of blocking on the
+    # full generation.
+    buffer = StringIO()
+    stream = client.models.generate_content_stream(
+        model=model or MODEL_NAME,
+        contents=parts,
+        config=config or types.GenerateContentConfig(max_output_tokens=4096)
+    )
     try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=parts,
-            config=config or types.GenerateContentConfig(max_output_tokens=4096)
-        )
-        return response.text
-    except Exception as e:
-        st.exception(f"API Error during stage execution: {e}")
-        return None
+        for chunk in stream:
+            if chunk.text:
+                buffer.write(chunk.text)
+                if placeholder is not None:
+                    placeholder.markdown(buffer.getvalue())
+                if stop_when is not None and stop_when(chunk.text):
+                    break
+    finally:
+        # An early break leaves the response half-read; close the generator so
+        # the underlying connection is released deterministically instead of
+        # being left to garbage collection.
+        stream.close()
+    return buffer.getvalue()
 
 # =================================================================
 # 4. THE MAIN ANALYSIS CHAIN FUNCTION
 # =================================================================
 
-def run_financial_analysis_chain(uploaded_file, file_mime_type):
-    """Executes the complete multi-stage prompt chain."""
-    
-    file_bytes = uploaded_file.read()
-
-    file_part = types.Part.from_bytes(
-        data=file_bytes,
-        mime_type=file_mime_type
+@st.cache_resource(ttl=3600, show_spinner=False)
+def get_uploaded_file_part(file_sha, _file_bytes, file_mime_type):
+    """Uploads the document once via the Gemini Files API and returns a URI Part.
+
+    Keyed by the document hash so Streamlit reruns and every stage that needs
+    the document reuse the same server-side handle instead of re-sending
+    (and base64-encoding) the full bytes with each request.
+    """
+    uploaded = client.files.upload(
+        file=BytesIO(_file_bytes),
+        config={"mime_type": file_mime_type}
     )
-
-    # --- STAGE 1: Data Extraction (Structured Output) ---
+    return types.Part.from_uri(file_uri=uploaded.uri, mime_type=file_mime_type)
+
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def run_stage1_extraction(file_sha, _file_bytes, file_mime_type, model_name=MODEL_NAME):
+    """Runs Stage 1 extraction, cached by document hash.
+
+    Cached separately from the full chain so that the (expensive, multimodal)
+    extraction is reused even when only the downstream prompts change.
+    `_file_bytes` is underscore-prefixed so Streamlit keys the cache on the
+    cheap sha256 digest instead of hashing the raw document again.
+    """
+    file_part = get_uploaded_file_part(file_sha, _file_bytes, file_mime_type)
+    stage1_config = types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=get_stage1_schema()
+    )
+    # The tracker ends the stream the instant the top-level JSON object
+    # closes, so the fused stage is not gated on trailing chunks or stream
+    # teardown.
+    tracker = JsonObjectTracker()
+    json_output = run_gemini_stage(
+        STAGE_1_PROMPT, file_part, stage1_config, stop_when=tracker.feed, model=model_name
+    )
+    if not json_output:
+        raise StageError("Stage 1 extraction returned an empty response.")
+    return json_output
+
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def run_stage1_5_summary(file_sha, _file_bytes, file_mime_type, model_name=SYNTHESIS_MODEL):
+    """Runs the Stage 1.5 plain-language overview, cached by document hash."""
+    file_part = get_uploaded_file_part(file_sha, _file_bytes, file_mime_type)
+    summary_config = types.GenerateContentConfig(max_output_tokens=256)
+    overview = run_gemini_stage(STAGE_1_5_PROMPT, file_part, summary_config, model=model_name)
+    if not overview:
+        raise StageError("Stage 1.5 overview returned an empty response.")
+    return overview
+
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def run_financial_analysis_chain(file_sha, _file_bytes, file_mime_type, model_name=MODEL_NAME, synthesis_model=SYNTHESIS_MODEL):
+    """Executes the complete multi-stage prompt chain.
+
+    Results are cached by the document's sha256 digest and both model names
+    (extraction and synthesis), so re-analyzing the same upload returns
+    instantly, while changing either model constant invalidates the cache.
+    """
+
+    # --- STAGE 1 + 1.5: Data Extraction and Document Overview (concurrent) ---
+    # Both calls are I/O-bound, so the overview's cost hides entirely behind
+    # the extraction latency.
     with st.spinner("Stage 1: Analyzing document and extracting structured data..."):
-        time.sleep(0.5) 
-        stage1_config = types.GenerateContentConfig(
-            response_mime_type="application/json",
-            response_schema=STAGE_1_SCHEMA
-        )
-        json_output = run_gemini_stage(STAGE_1_PROMPT, file_part, stage1_config)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            extraction_future = executor.submit(
+                run_stage1_extraction, file_sha, _file_bytes, file_mime_type, model_name
+            )
+            summary_future = executor.submit(
+                run_stage1_5_summary, file_sha, _file_bytes, file_mime_type, synthesis_model
+            )
+            # Extraction failures propagate to the script thread; the overview
+            # only enriches the report, so its failure is not fatal.
+            json_output = extraction_future.result()
+            try:
+                executive_preamble = summary_future.result()
+            except Exception:
+                executive_preamble = None
+
+    if not json_output:
+        raise StageError("Stage 1 returned an empty response.")
 
-    if not json_output: return None
-    
     try:
-        extracted_data_json = json.dumps(json.loads(json_output), indent=2)
+        # Parse exactly once; the parsed object is validated and then reused
+        # for the downstream serialization (pretty-printing happens lazily in
+        # the debug expander).
+        parsed_metrics = json.loads(json_output)
+        get_stage1_validator()(parsed_metrics)
     except json.JSONDecodeError:
-        st.error("Stage 1 failed: Gemini did not return valid JSON. Check document structure.")
-        st.code(json_output, language='json')
-        return None
-    
-    st.success("Stage 1 Complete: Structured Data Extracted.")
+        raise StageError(
+            "Stage 1 failed: Gemini did not return valid JSON. Check document structure.",
+            raw_output=json_output
+        )
+    except fastjsonschema.JsonSchemaValueException as e:
+        raise StageError(
+            f"Stage 1 failed: extracted data does not match the expected schema: {e.message}",
+            raw_output=json_output
+        )
 
+    # Re-serialize from the parsed object so the downstream prompt sees a
+    # normalized payload, independent of any pretty-printer artifacts in the
+    # raw model text. Compact separators: the model reads this as opaque text,
+    # and whitespace is pure prefill-token overhead.
+    extracted_data_json = json.dumps(parsed_metrics, separators=(",", ":"))
 
-    # --- STAGE 2: Analytical Reasoning (CoT) ---
-    with st.spinner("Stage 2: Performing Chain-of-Thought calculations and analysis..."):
-        time.sleep(0.5) 
-        stage2_full_prompt = STAGE_2_PROMPT_TEMPLATE.format(extracted_data_placeholder=extracted_data_json)
-        
-        # NOTE: Stage 2 prompt is passed as text, contents=[] is an empty list as no file is used here.
-        stage2_output = run_gemini_stage(stage2_full_prompt, [])
+    st.success("Stage 1 Complete: Structured Data Extracted.")
 
-    if not stage2_output: return None
-    st.success("Stage 2 Complete: Analysis Ready.")
 
-    match = re.search(r'(<Chain_of_Thought>[\s\S]*<\/Intermediate_Analysis>)', stage2_output, re.DOTALL)
-    intermediate_analysis = match.group(1) if match else stage2_output
+    # --- STAGE 2+3 (fused): Analytical Reasoning and Executive Report ---
+    # A single generation emits the CoT analysis followed by the final report,
+    # saving one full request round-trip (TTFT + HTTPS overhead) and sending
+    # the Stage 1 JSON over the wire only once.
+    with st.spinner("Stage 2+3: Performing Chain-of-Thought analysis and generating executive report..."):
+        fused_prompt = STAGE_2_3_PROMPT_TEMPLATE.format(
+            extracted_data_placeholder=extracted_data_json,
+            executive_preamble_placeholder=executive_preamble or "Not available."
+        )
 
+        # NOTE: The fused prompt is passed as text, contents=[] is an empty list as no file is used here.
+        # The placeholder streams the raw output as it is generated; it is cleared once the
+        # final report is rendered in the results section below.
+        # ~1,500 tokens of CoT plus a ~600-token report fit comfortably in 2048;
+        # capping the budget bounds worst-case generation time.
+        fused_config = types.GenerateContentConfig(
+            system_instruction=SYNTHESIS_SYSTEM_INSTRUCTION,
+            max_output_tokens=2048
+        )
+        report_placeholder = st.empty()
+        fused_output = run_gemini_stage(
+            fused_prompt, [], fused_config,
+            placeholder=report_placeholder, model=synthesis_model
+        )
+        report_placeholder.empty()
 
-    # --- STAGE 3: Synthesis and Actionable Suggestions ---
-    with st.spinner("Stage 3: Generating executive report..."):
-        time.sleep(0.5) 
-        full_analysis_data = f"STAGE 1 DATA:\n{extracted_data_json}\n\nSTAGE 2 ANALYSIS:\n{intermediate_analysis}"
-        stage3_full_prompt = STAGE_3_PROMPT_TEMPLATE.format(full_analysis_data_placeholder=full_analysis_data)
+    if not fused_output:
+        raise StageError("Stage 2+3 returned an empty response.")
 
-        # NOTE: Stage 3 prompt is passed as text, contents=[] is an empty list as no file is used here.
-        final_report_markdown = run_gemini_stage(stage3_full_prompt, [])
+    # One split: the CoT/analysis block feeds the debug expander, everything
+    # after the closing </Intermediate_Analysis> tag is the final report.
+    match = FUSED_OUTPUT_RE.search(fused_output)
+    if match:
+        stage2_output = match.group(1)
+        final_report_markdown = match.group(2).strip()
+    else:
+        stage2_output = fused_output
+        final_report_markdown = fused_output
 
-    if not final_report_markdown: return None
+    if not final_report_markdown:
+        raise StageError("Stage 2+3 produced no final report after the analysis block.", raw_output=fused_output)
     st.success("✅ Analysis Complete! Report Generated.")
 
     return final_report_markdown, extracted_data_json, stage2_output
@@ -222,7 +447,10 @@ def run_financial_analysis_chain(uploaded_file, file_mime_type):
 st.title("Gemini Financial Strategy Dashboard")
 st.markdown("---")
 st.markdown("""
-A **3-Stage Prompt Chaining** application using **Gemini 2.5 Pro** to perform secure, structured analysis of financial reports.
+A **prompt-chaining** application for secure, structured analysis of financial reports:
+**Gemini 2.5 Pro** extracts structured data while **Gemini 2.5 Flash** drafts a document
+overview in parallel, then a single fused Chain-of-Thought + synthesis call produces the
+executive report.
 """)
 
 # File Uploader
@@ -233,15 +461,35 @@ uploaded_file = st.file_uploader(
 )
 
 if uploaded_file:
-    # Get the file extension and map to MIME type
-    if uploaded_file.type == 'application/pdf':
-        mime_type = 'application/pdf'
-    else:
-        mime_type = 'text/plain' 
-
-    if st.button("▶️ Execute 3-Stage Analysis Chain", use_container_width=True, type="primary"):
-        # Run the analysis and get results
-        report_data = run_financial_analysis_chain(uploaded_file, mime_type)
+    # Map the upload's content type to the MIME type sent to Gemini
+    mime_type = MIME_TYPE_MAP.get(uploaded_file.type, "text/plain")
+
+    if st.button("▶️ Execute Analysis Pipeline", use_container_width=True, type="primary"):
+        # Hash the upload so identical documents hit the analysis cache.
+        # getvalue() returns the already-buffered bytes without moving the file
+        # cursor; read() would return b"" on a rerun once the pointer is at EOF.
+        file_bytes = uploaded_file.getvalue()
+        file_sha = hashlib.sha256(file_bytes).hexdigest()
+
+        # Run the analysis and get results. Failures raise out of the cached
+        # chain (so they are never cached) and are reported here.
+        try:
+            # Pass both models explicitly: st.cache_data only hashes arguments
+            # actually supplied, so defaulted parameters would not key the
+            # cache on the model constants.
+            report_data = run_financial_analysis_chain(
+                file_sha, file_bytes, mime_type, MODEL_NAME, SYNTHESIS_MODEL
+            )
+        except StageError as e:
+            st.error(f"Analysis failed: {e}")
+            if e.raw_output:
+                st.code(e.raw_output, language='json')
+            report_data = None
+        except Exception as e:
+            # API errors raised on worker threads surface here, on the script
+            # thread, where the element can actually render.
+            st.exception(e)
+            report_data = None
         
         if report_data:
             final_report_markdown, extracted_json, stage2_output = report_data
@@ -266,7 +514,10 @@ if uploaded_file:
             # --- Debug/Intermediate Output ---
             with st.expander("Show Intermediate Analysis (Debug)", expanded=False):
                 st.subheader("Stage 1: Extracted Metrics (Structured JSON)")
-                st.code(extracted_json, language='json')
+                # Pretty-print only here, for human inspection.
+                st.code(json.dumps(json.loads(extracted_json), indent=2), language='json')
                 
                 st.subheader("Stage 2: Chain-of-Thought Reasoning (CoT)")
-                st.code(stage2_output, language='markdown')
+                # Plain text: st.code would run syntax highlighting over the
+                # whole multi-KB CoT on every rerun for no benefit.
+                st.text(stage2_output)